@@ -36,6 +36,18 @@ class Config(DataRobotAppFrameworkBaseSettings):
     use_datarobot_llm_gateway: bool = False
     mcp_deployment_id: str | None = None
     external_mcp_url: str | None = None
+    # Use the query optimizer -> RAG searcher -> answer refiner workflow instead
+    # of a single tool-using agent.
+    multi_stage_rag: bool = False
+    # In-process cache of RAG results keyed by the normalized question; a size
+    # of 0 disables it. Off by default: it sits in front of the MCP server's own
+    # response cache (DR_RAG_CACHE_TTL), so enabling it extends how long a stale
+    # answer can be served to RAG_CACHE_TTL_SECONDS. Both caches are off unless
+    # RAG_CACHE_SIZE, RAG_CACHE_PATH or DR_RAG_CACHE_TTL is set.
+    rag_cache_size: int = Field(default=0, ge=0)
+    rag_cache_ttl_seconds: float = Field(default=3600, ge=0)
+    # Optional SQLite file backing the RAG cache across restarts and workers.
+    rag_cache_path: str | None = None
 
     local_dev_port: int = Field(
         default=8842, validation_alias="AGENT_PORT", ge=1, le=65535
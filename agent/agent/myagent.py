@@ -11,47 +11,253 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import logging
+import re
+from collections.abc import AsyncGenerator
+from functools import cached_property
 from typing import Any
 
-from datarobot_genai.core.agents import (
-    make_system_prompt,
-)
+from datarobot_genai.core.agents.base import UsageMetrics
 from datarobot_genai.langgraph.agent import LangGraphAgent
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    HumanMessage,
+    SystemMessage,
+)
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.tools import BaseTool
 from langchain_litellm.chat_models import ChatLiteLLM
 from langgraph.graph import END, START, MessagesState, StateGraph
 from langgraph.prebuilt import create_react_agent
 
 from agent.config import Config
+from agent.prompts import (
+    ANSWER_REFINER_PROMPT,
+    NO_RESULTS_ANSWER,
+    QUERY_OPTIMIZER_PROMPT,
+    RAG_AGENT_PROMPT,
+)
+from agent.rag_cache import (
+    RAGResultCache,
+    SQLiteRAGResultStore,
+    cached_rag_tool,
+    normalize_question,
+)
+
+logger = logging.getLogger(__name__)
 
 config = Config()
 
+# Name of the MCP tool exposed by the RAG deployment (see mcp_server/app/tools).
+RAG_TOOL_NAME = "query_datarobot_rag"
+
+# The RAG tool reports failures as text starting with this prefix.
+RAG_ERROR_PREFIX = "Error:"
+RAG_TOOL_UNAVAILABLE = f"{RAG_ERROR_PREFIX} the {RAG_TOOL_NAME} tool is not available."
+
+# Heading the RAG tool puts before its citations; absent when nothing was retrieved.
+RAG_CITATIONS_MARKER = "**References:**"
+
+# A citation line under the heading, e.g. "[2] handbook.pdf (p.14)".
+_REFERENCE_LINE = re.compile(r"^\[\d+\] (?P<source>.+?)(?: \(p\.(?P<page>[^)]*)\))?$")
+
+# Source the MCP server shows for citations whose metadata has none; it keeps
+# every such citation as its own entry.
+_UNKNOWN_SOURCE = "Unknown"
+
+# Shared across requests: a new MyAgent is created for every completion request.
+rag_result_cache = RAGResultCache(
+    maxsize=config.rag_cache_size,
+    ttl_seconds=config.rag_cache_ttl_seconds,
+    # The RAG tool is served by the MCP server, so it identifies the source.
+    namespace=config.mcp_deployment_id or config.external_mcp_url or "",
+    store=(
+        SQLiteRAGResultStore(config.rag_cache_path, config.rag_cache_ttl_seconds)
+        if config.rag_cache_path
+        else None
+    ),
+)
+
+
+class RAGState(MessagesState):
+    """Graph state shared by the RAG workflow nodes.
+
+    `probe_result` carries the raw-query retrieval from the `rag_probe` branch so
+    that it does not interleave with the optimizer's messages while both branches
+    run in parallel; `merge_results` folds it back into `messages`.
+    """
+
+    probe_result: str
+
+
+def _is_rag_answer(result: str) -> bool:
+    """Return whether a RAG tool result is an answer rather than empty or an error."""
+    return bool(result.strip()) and not result.startswith(RAG_ERROR_PREFIX)
+
+
+def _reference_keys(result: str) -> set[tuple[str, str]]:
+    """Return the (source, page) of every citation in a RAG tool result."""
+    _, _, references = result.partition(RAG_CITATIONS_MARKER)
+    return {
+        (match["source"], match["page"] or "")
+        for line in references.splitlines()
+        if (match := _REFERENCE_LINE.match(line.strip()))
+    }
+
+
+def _cacheable_prompt(llm: ChatLiteLLM, prompt: str) -> str | SystemMessage:
+    """Mark a static system prompt for provider-side prompt caching.
+
+    The system prompt is always the first message, ahead of the conversation, so
+    OpenAI-compatible deployments cache it automatically. Anthropic models only
+    cache blocks that carry an explicit `cache_control` marker.
+    """
+    model = llm.model.lower()
+    if "anthropic" not in model and "claude" not in model:
+        return prompt
+    return SystemMessage(
+        content=[
+            {"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}
+        ]
+    )
+
+
+def _message_text(content: Any) -> str:
+    """Flatten message or tool content (string or content blocks) into text."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            block if isinstance(block, str) else str(block.get("text", ""))
+            for block in content
+        )
+    return str(content)
+
+
+def _latest_question(messages: list[Any]) -> str:
+    """Return the text of the most recent user message, or "" if there is none."""
+    return next(
+        (
+            _message_text(message.content)
+            for message in reversed(messages)
+            if isinstance(message, HumanMessage)
+        ),
+        "",
+    )
+
 
 class MyAgent(LangGraphAgent):
     """Advanced RAG agent with query optimization, search, and answer refinement.
 
-    Uses a three-node workflow:
+    By default a single tool-using agent rewrites the question, calls the RAG tool
+    with the optimized query, and answers with citations, all in one react loop.
+
+    With `MULTI_STAGE_RAG` enabled it instead uses a fan-out/fan-in workflow:
       1. Query Optimizer  – rewrites the user's question into search-friendly terms.
-      2. RAG Searcher     – calls the RAG deployment to retrieve relevant chunks.
-      3. Answer Refiner   – evaluates retrieved chunks and generates a refined answer.
+         RAG Probe        – in parallel, searches the knowledge base with the raw question.
+      2. RAG Searcher     – calls the RAG tool directly with the optimized query.
+      3. Merge Results    – joins both retrieval branches into the conversation.
+      4. Answer Refiner   – evaluates retrieved chunks and generates a refined answer.
+         No Results       – instead answers directly when nothing was retrieved
+                            or the retrieval failed.
+
+    The probe hides the latency of the optimizer's LLM call behind a retrieval
+    that does not depend on it.
+
+    A new instance serves every request, as the LLM credentials and MCP tool
+    sessions are scoped to it; the node agents are cached on the instance, so
+    they are not shared between requests. Only the RAG result cache is shared:
+    results of the RAG tool can be cached by normalized question, opt-in
+    through RAG_CACHE_SIZE or RAG_CACHE_PATH.
     """
 
+    # Nodes whose LLM output is the user-facing answer. Token chunks from every
+    # other node are consumed internally and are not streamed to the client.
+    _STREAMED_NODES = frozenset({"rag_agent", "answer_refiner", "no_results"})
+
+    def set_mcp_tools(self, tools: list[BaseTool]) -> None:
+        if not rag_result_cache.enabled:
+            super().set_mcp_tools(tools)
+            return
+        # Serve repeated questions to the RAG tool from the shared result cache.
+        super().set_mcp_tools(
+            [
+                cached_rag_tool(tool, rag_result_cache, _message_text)
+                if getattr(tool, "name", None) == RAG_TOOL_NAME
+                else tool
+                for tool in tools
+            ]
+        )
+
     @property
     def workflow(self) -> StateGraph[MessagesState]:
+        if not config.multi_stage_rag:
+            single_stage_workflow = StateGraph(MessagesState)
+            single_stage_workflow.add_node("rag_agent", self.agent_rag)
+            single_stage_workflow.add_edge(START, "rag_agent")
+            single_stage_workflow.add_edge("rag_agent", END)
+            return single_stage_workflow
+
         langgraph_workflow = StateGraph[
             MessagesState, None, MessagesState, MessagesState
-        ](MessagesState)
+        ](RAGState)
 
         langgraph_workflow.add_node("query_optimizer", self.agent_query_optimizer)
-        langgraph_workflow.add_node("rag_searcher", self.agent_rag_searcher)
+        langgraph_workflow.add_node("rag_probe", self.rag_probe)
+        langgraph_workflow.add_node("rag_searcher", self.rag_searcher)
+        langgraph_workflow.add_node("merge_results", self.merge_results)
         langgraph_workflow.add_node("answer_refiner", self.agent_answer_refiner)
+        langgraph_workflow.add_node("no_results", self.no_results)
 
+        # Fan out: the probe does not depend on the optimizer's output.
         langgraph_workflow.add_edge(START, "query_optimizer")
+        langgraph_workflow.add_edge(START, "rag_probe")
         langgraph_workflow.add_edge("query_optimizer", "rag_searcher")
-        langgraph_workflow.add_edge("rag_searcher", "answer_refiner")
+
+        # Fan in: wait for both retrieval branches before refining the answer.
+        langgraph_workflow.add_edge(["rag_searcher", "rag_probe"], "merge_results")
+        # Skip the refiner's LLM call when there is nothing to refine.
+        langgraph_workflow.add_conditional_edges(
+            "merge_results",
+            self.route_retrievals,
+            {"refine": "answer_refiner", "empty": "no_results"},
+        )
         langgraph_workflow.add_edge("answer_refiner", END)
+        langgraph_workflow.add_edge("no_results", END)
+
+        return langgraph_workflow
+
+    async def _stream_generator(
+        self,
+        graph_stream: AsyncGenerator[tuple[Any, str, Any], None],
+        usage_metrics: UsageMetrics,
+    ) -> AsyncGenerator[tuple[Any, Any, UsageMetrics], None]:
+        async def final_node_stream() -> AsyncGenerator[tuple[Any, str, Any], None]:
+            async for namespace, mode, event in graph_stream:
+                if mode == "messages":
+                    # Subgraph chunks are namespaced as ("<node>:<task id>", ...).
+                    node = (
+                        namespace[0].partition(":")[0]
+                        if namespace
+                        else event[1].get("langgraph_node")
+                    )
+                    if node not in self._STREAMED_NODES:
+                        continue
+                    message, metadata = event
+                    # Messages returned whole by plain nodes (e.g. no_results) are
+                    # emitted as AIMessage; the base class only streams chunks.
+                    if isinstance(message, AIMessage) and not isinstance(
+                        message, AIMessageChunk
+                    ):
+                        event = (
+                            AIMessageChunk(content=message.content, id=message.id),
+                            metadata,
+                        )
+                yield namespace, mode, event
 
-        return langgraph_workflow  # type: ignore[return-value]
+        async for item in super()._stream_generator(final_node_stream(), usage_metrics):
+            yield item
 
     @property
     def prompt_template(self) -> ChatPromptTemplate:
@@ -68,6 +274,7 @@ class MyAgent(LangGraphAgent):
         self,
         preferred_model: str | None = None,
         auto_model_override: bool = True,
+        streaming: bool = False,
     ) -> ChatLiteLLM:
         """Returns the ChatLiteLLM to use for a given model.
 
@@ -80,6 +287,9 @@ class MyAgent(LangGraphAgent):
             auto_model_override: Optional[bool]: If True, it will try and use the model
                 specified in the request but automatically back out if the LLM Gateway is
                 not available.
+            streaming: bool: Stream tokens from the LLM. Only nodes whose output is
+                shown to the user should stream; internal nodes consume the full
+                message and streaming only adds chunk-parsing overhead.
 
         Returns:
             ChatLiteLLM: The model to use.
@@ -90,109 +300,183 @@ class MyAgent(LangGraphAgent):
             model = config.llm_default_model
         if auto_model_override and not config.use_datarobot_llm_gateway:
             model = config.llm_default_model
-        if self.verbose:
-            print(f"Using model: {model}")
+        logger.debug("Using model: %s", model)
         return ChatLiteLLM(
             model=model,
             api_base=api_base,
             api_key=self.api_key,
             timeout=self.timeout,
-            streaming=True,
+            streaming=streaming,
             max_retries=3,
         )
 
+    def _rag_tool(self) -> BaseTool | None:
+        return next(
+            (tool for tool in self.mcp_tools if tool.name == RAG_TOOL_NAME), None
+        )
+
+    # ------------------------------------------------------------------
+    # Single-stage: RAG Agent
+    # ------------------------------------------------------------------
+
+    @cached_property
+    def agent_rag(self) -> Any:
+        """Optimizes the query, searches, and answers in a single react loop."""
+        llm = self.llm(streaming=True)
+        return create_react_agent(
+            llm,
+            tools=self.mcp_tools,
+            prompt=_cacheable_prompt(llm, RAG_AGENT_PROMPT),
+            name="RAG Agent",
+        )
+
     # ------------------------------------------------------------------
     # Node 1: Query Optimizer
     # ------------------------------------------------------------------
 
-    @property
+    @cached_property
     def agent_query_optimizer(self) -> Any:
         """Rewrites the user's question into an optimized vector-search query."""
+        llm = self.llm(streaming=False)
         return create_react_agent(
-            self.llm(),
-            tools=self.mcp_tools,
-            prompt=make_system_prompt(
-                "あなたは検索クエリ最適化の専門家です。\n"
-                "\n"
-                "あなたのタスクは、ユーザーの質問をベクトルデータベース検索に最適化された"
-                "クエリに書き換えることです。以下のルールに従ってください：\n"
-                "1. 挨拶、つなぎ言葉、不要な文脈を削除する。\n"
-                "2. 主要な概念、エンティティ、専門用語を抽出する。\n"
-                "3. ドキュメントに含まれる可能性のある同義語や関連用語を含める。\n"
-                "4. 会話履歴からフォローアップの質問であると判断される場合、代名詞や"
-                "指示語を解決する（例：「それ」や「あれ」を前のメッセージの実際の"
-                "主題に置き換える）。\n"
-                "5. クエリは簡潔かつ包括的に保つ。\n"
-                "6. 元の質問の言語を維持する。\n"
-                "\n"
-                "最適化された検索クエリテキストのみを出力してください。質問に自分で"
-                "回答したり、説明を追加したり、ツールを使用したりしないでください。",
-            ),
+            llm,
+            # Instructed not to use tools; binding none keeps the tool schemas out
+            # of the prompt and the agent independent of the per-request MCP tools.
+            tools=[],
+            prompt=_cacheable_prompt(llm, QUERY_OPTIMIZER_PROMPT),
             name="Query Optimizer",
         )
 
+    # ------------------------------------------------------------------
+    # Node 1b: RAG Probe (runs in parallel with the Query Optimizer)
+    # ------------------------------------------------------------------
+
+    async def rag_probe(self, state: RAGState) -> dict[str, Any]:
+        """Searches the knowledge base with the user's raw question.
+
+        A missing RAG tool is reported here, once, rather than by both branches.
+        """
+        rag_tool = self._rag_tool()
+        if rag_tool is None:
+            return {"probe_result": RAG_TOOL_UNAVAILABLE}
+        question = _latest_question(state["messages"])
+        if not question:
+            return {"probe_result": ""}
+        result = await rag_tool.ainvoke({"question": question})
+        return {"probe_result": _message_text(result)}
+
     # ------------------------------------------------------------------
     # Node 2: RAG Searcher
     # ------------------------------------------------------------------
 
-    @property
-    def agent_rag_searcher(self) -> Any:
-        """Searches the knowledge base using the optimized query."""
-        return create_react_agent(
-            self.llm(),
-            tools=self.mcp_tools,
-            prompt=make_system_prompt(
-                "あなたはドキュメント検索エージェントです。\n"
-                "\n"
-                "前のアシスタントメッセージには最適化された検索クエリが含まれています。"
-                "あなたの仕事は、そのクエリを使用してナレッジベースを検索することです。\n"
-                "\n"
-                "手順：\n"
-                "1. 前のアシスタントメッセージから最適化された検索クエリを抽出する。\n"
-                "2. そのクエリを 'question' パラメータとして query_datarobot_rag ツールを"
-                "呼び出す。クエリを変更しないこと。\n"
-                "3. 参照や引用を含むツールの応答をそのまま完全に返す。結果を要約したり"
-                "書き換えたりしないこと。\n"
-                "\n"
-                "ユーザーの質問が会話のコンテキストを必要とするフォローアップである"
-                "場合は、代わりに query_datarobot_rag_with_context を使用してください。",
+    async def rag_searcher(self, state: RAGState) -> dict[str, Any]:
+        """Searches the knowledge base using the optimized query.
+
+        The optimizer's last message is the query itself, so the tool is called
+        directly rather than spending an LLM round-trip to echo it into a call.
+        When the optimizer left the question unchanged, the RAG Probe already
+        retrieved it and the search is skipped.
+        """
+        rag_tool = self._rag_tool()
+        query = _message_text(state["messages"][-1].content).strip()
+        if rag_tool is None or not query:
+            return {"messages": []}
+        if normalize_question(query) == normalize_question(
+            _latest_question(state["messages"])
+        ):
+            return {"messages": []}
+        result = await rag_tool.ainvoke({"question": query})
+        return {
+            "messages": [AIMessage(content=_message_text(result), name="RAG Searcher")]
+        }
+
+    # ------------------------------------------------------------------
+    # Join: Merge Results
+    # ------------------------------------------------------------------
+
+    def merge_results(self, state: RAGState) -> dict[str, Any]:
+        """Appends the raw-query retrieval so the refiner sees both result sets.
+
+        The probe result is dropped when the optimized query's search succeeded
+        and already cites every document the probe cites, so the refiner is not
+        sent the same references twice. A probe citing an "Unknown" source is
+        always kept, as the MCP server does not deduplicate those either.
+        """
+        probe_result = state.get("probe_result", "")
+        if not probe_result:
+            return {"messages": []}
+        searcher_result = next(
+            (
+                _message_text(message.content)
+                for message in reversed(state["messages"])
+                if message.name == "RAG Searcher"
+            ),
+            None,
+        )
+        # A failed search cannot stand in for the probe, whatever it cites.
+        if searcher_result is not None and _is_rag_answer(searcher_result):
+            probe_keys = _reference_keys(probe_result)
+            new_references = probe_keys - _reference_keys(searcher_result)
+            # Source-less citations cannot be matched, so they always count as new.
+            if not new_references and not any(
+                source == _UNKNOWN_SOURCE for source, _ in probe_keys
+            ):
+                return {"messages": []}
+        return {"messages": [AIMessage(content=probe_result, name="RAG Probe")]}
+
+    # ------------------------------------------------------------------
+    # Branch: No Results (taken instead of the Answer Refiner)
+    # ------------------------------------------------------------------
+
+    def route_retrievals(self, state: RAGState) -> str:
+        """Routes to the refiner if any retrieval branch returned an answer.
+
+        An answer without citations is still routed to the refiner; only empty
+        and failed retrievals fall through to `no_results`.
+        """
+        for message in state["messages"]:
+            if message.name in ("RAG Searcher", "RAG Probe") and _is_rag_answer(
+                _message_text(message.content)
+            ):
+                return "refine"
+        return "empty"
+
+    def no_results(self, state: RAGState) -> dict[str, Any]:
+        """Tells the user nothing relevant was found, without calling the LLM.
+
+        When a retrieval failed, the tool's error is shown instead, so an outage
+        is not reported as the knowledge base having no answer.
+        """
+        error = next(
+            (
+                text
+                for message in state["messages"]
+                if message.name in ("RAG Searcher", "RAG Probe")
+                and (text := _message_text(message.content)).startswith(
+                    RAG_ERROR_PREFIX
+                )
             ),
-            name="RAG Searcher",
+            None,
         )
+        return {
+            "messages": [
+                AIMessage(content=error or NO_RESULTS_ANSWER, name="No Results")
+            ]
+        }
 
     # ------------------------------------------------------------------
     # Node 3: Answer Refiner
     # ------------------------------------------------------------------
 
-    @property
+    @cached_property
     def agent_answer_refiner(self) -> Any:
         """Evaluates retrieved chunks and generates a refined answer."""
+        llm = self.llm(streaming=True)
         return create_react_agent(
-            self.llm(),
-            tools=self.mcp_tools,
-            prompt=make_system_prompt(
-                "あなたは回答品質の専門家です。\n"
-                "\n"
-                "この会話の中で、以下のコンテキストにアクセスできます：\n"
-                "- ユーザーの元の質問（最初のヒューマンメッセージ）。\n"
-                "- ナレッジベースから取得された参照付きの検索結果"
-                "（前のアシスタントメッセージ内）。\n"
-                "\n"
-                "あなたのタスク：\n"
-                "1. 評価：検索結果の各参照・引用をレビューする。どの参照がユーザーの"
-                "元の質問に本当に関連しているか、どれが関連していないかを判断する。\n"
-                "2. 生成：関連する参照からの情報のみを使用して、包括的な回答を作成する。"
-                "特定のソースを参照する際は、番号付きの引用マーカー"
-                "（例：[1]、[2]）を含める。\n"
-                "3. 引用：実際に使用したソースを一覧にした参考文献セクションを末尾に"
-                "追加する。\n"
-                "\n"
-                "ルール：\n"
-                "- ツールを使用しないこと。既に提供された情報のみで作業する。\n"
-                "- 情報を捏造しないこと。関連する情報が見つからなかった場合は、"
-                "正直にユーザーに伝える。\n"
-                "- ユーザーの元の質問と同じ言語で回答する。\n"
-                "- 包括的かつ簡潔に回答する。",
-            ),
+            llm,
+            # Instructed not to use tools; binding none keeps the tool schemas out
+            # of the prompt and the agent independent of the per-request MCP tools.
+            tools=[],
+            prompt=_cacheable_prompt(llm, ANSWER_REFINER_PROMPT),
             name="Answer Refiner",
         )
@@ -0,0 +1,203 @@
+# Copyright 2025 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Caching of RAG tool results so repeated questions skip the RAG deployment.
+"""
+
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from langchain_core.tools import BaseTool, StructuredTool
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Collapse whitespace and case so trivially different questions share a key."""
+    return " ".join(question.split()).casefold()
+
+
+class SQLiteRAGResultStore:
+    """Persistent RAG results in a SQLite file.
+
+    Entries survive restarts and are shared by every worker process that points
+    at the same file. Expiry uses wall-clock time for that reason.
+
+    The file is not opened until the first lookup, so a bad path surfaces as a
+    `sqlite3.Error` from `get`/`put` rather than at construction.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 3600) -> None:
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._table_created = False
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            with connection:
+                if not self._table_created:
+                    connection.execute(
+                        "CREATE TABLE IF NOT EXISTS rag_results (key BLOB PRIMARY KEY, "
+                        "stored_at REAL NOT NULL, result TEXT NOT NULL)"
+                    )
+                    self._table_created = True
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key: bytes) -> str | None:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT stored_at, result FROM rag_results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            stored_at, result = row
+            if time.time() - stored_at >= self.ttl_seconds:
+                connection.execute("DELETE FROM rag_results WHERE key = ?", (key,))
+                return None
+            return str(result)
+
+    def put(self, key: bytes, result: str) -> None:
+        now = time.time()
+        with self._connect() as connection:
+            # Expired rows are otherwise only removed when their key is read
+            # again, so prune them here to keep the file from growing unbounded.
+            connection.execute(
+                "DELETE FROM rag_results WHERE stored_at <= ?",
+                (now - self.ttl_seconds,),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO rag_results VALUES (?, ?, ?)",
+                (key, now, result),
+            )
+
+
+class RAGResultCache:
+    """LRU cache of RAG results keyed by the normalized question.
+
+    Entries expire after `ttl_seconds` so that updates to the knowledge base are
+    eventually picked up. A `maxsize` of 0 disables the in-process tier. When a
+    `store` is given it backs the in-process tier, so results outlive the process
+    and are shared between workers.
+
+    `namespace` identifies the RAG source; it is part of every key so that
+    results from different deployments never collide in a shared store.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl_seconds: float = 3600,
+        namespace: str = "",
+        store: SQLiteRAGResultStore | None = None,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace
+        self.store = store
+        self._entries: OrderedDict[bytes, tuple[float, str]] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether either tier can serve a result."""
+        return self.maxsize > 0 or self.store is not None
+
+    def key(self, question: str) -> bytes:
+        return hashlib.blake2b(
+            f"{self.namespace}\0{normalize_question(question)}".encode()
+        ).digest()
+
+    def get(self, question: str) -> str | None:
+        key = self.key(question)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at >= self.ttl_seconds:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, question: str, result: str) -> None:
+        if self.maxsize <= 0:
+            return
+        key = self.key(question)
+        self._entries[key] = (time.monotonic(), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    async def get_or_fetch(
+        self, question: str, fetch: Callable[[str], Awaitable[str]]
+    ) -> str:
+        """Return the cached result for `question`, calling `fetch` on a miss."""
+        cached = self.get(question)
+        if cached is not None:
+            return cached
+        # The store is an optimization: if it fails (locked, unwritable or
+        # corrupt file), the question is answered by the RAG tool as usual.
+        if self.store is not None:
+            try:
+                stored = await asyncio.to_thread(self.store.get, self.key(question))
+            except sqlite3.Error:
+                logger.warning("Reading the RAG result store failed", exc_info=True)
+                stored = None
+            if stored is not None:
+                self.put(question, stored)
+                return stored
+        result = await fetch(question)
+        # Error messages from the MCP tool (e.g. a missing deployment) and empty
+        # results are not cached so that a fixed configuration takes effect.
+        if result and not result.startswith("Error:"):
+            self.put(question, result)
+            if self.store is not None:
+                try:
+                    await asyncio.to_thread(self.store.put, self.key(question), result)
+                except sqlite3.Error:
+                    logger.warning("Writing the RAG result store failed", exc_info=True)
+        return result
+
+
+def cached_rag_tool(
+    tool: BaseTool, cache: RAGResultCache, to_text: Callable[[Any], str] = str
+) -> BaseTool:
+    """Wrap a RAG tool taking a `question` argument so its results are cached."""
+
+    async def fetch(question: str) -> str:
+        return to_text(await tool.ainvoke({"question": question}))
+
+    async def query(question: str) -> str:
+        return await cache.get_or_fetch(question, fetch)
+
+    return StructuredTool.from_function(
+        coroutine=query,
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        handle_tool_error=tool.handle_tool_error,
+    )
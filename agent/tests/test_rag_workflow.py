@@ -0,0 +1,500 @@
+# Copyright 2025 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests for the MyAgent RAG workflow graph and its Python (non-LLM) nodes.
+"""
+
+from typing import Any
+
+import pytest
+from ag_ui.core import TextMessageContentEvent
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    HumanMessage,
+    SystemMessage,
+)
+from langchain_core.tools import StructuredTool
+from langchain_litellm.chat_models import ChatLiteLLM
+from langgraph.graph import END, START
+
+from agent import MyAgent
+from agent.myagent import (
+    NO_RESULTS_ANSWER,
+    RAG_CITATIONS_MARKER,
+    RAG_TOOL_NAME,
+    RAG_TOOL_UNAVAILABLE,
+    _cacheable_prompt,
+    config,
+    rag_result_cache,
+)
+from agent.rag_cache import RAGResultCache, SQLiteRAGResultStore
+
+
+def create_rag_tool(calls: list[str], answer: str = "RAG answer") -> StructuredTool:
+    """Create a fake RAG tool that records the questions it was asked."""
+
+    async def query(question: str) -> str:
+        calls.append(question)
+        return f"{answer} for: {question}"
+
+    return StructuredTool.from_function(
+        coroutine=query, name=RAG_TOOL_NAME, description="Fake RAG tool"
+    )
+
+
+@pytest.fixture
+def agent() -> MyAgent:
+    return MyAgent(api_key="test_key", api_base="https://test.example.com")
+
+
+@pytest.fixture(autouse=True)
+def clear_rag_cache():
+    rag_result_cache.clear()
+    yield
+    rag_result_cache.clear()
+
+
+@pytest.fixture
+def multi_stage(monkeypatch):
+    monkeypatch.setattr(config, "multi_stage_rag", True)
+
+
+class TestWorkflowGraph:
+    def test_single_stage_workflow_is_default(self, agent):
+        graph = agent.workflow.compile().get_graph()
+        edges = {(edge.source, edge.target) for edge in graph.edges}
+
+        assert edges == {(START, "rag_agent"), ("rag_agent", END)}
+
+    @pytest.mark.usefixtures("multi_stage")
+    def test_optimizer_and_probe_fan_out_from_start(self, agent):
+        graph = agent.workflow.compile().get_graph()
+        edges = {(edge.source, edge.target) for edge in graph.edges}
+
+        assert (START, "query_optimizer") in edges
+        assert (START, "rag_probe") in edges
+        assert ("query_optimizer", "rag_searcher") in edges
+
+    @pytest.mark.usefixtures("multi_stage")
+    def test_branches_fan_in_before_answer_refiner(self, agent):
+        graph = agent.workflow.compile().get_graph()
+        edges = {(edge.source, edge.target) for edge in graph.edges}
+
+        assert ("rag_searcher", "merge_results") in edges
+        assert ("rag_probe", "merge_results") in edges
+        assert ("merge_results", "answer_refiner") in edges
+        assert ("merge_results", "no_results") in edges
+        assert ("answer_refiner", END) in edges
+        assert ("no_results", END) in edges
+
+
+class TestNodeCaching:
+    def test_llm_streaming_is_opt_in(self, agent):
+        assert agent.llm().streaming is False
+        assert agent.llm(streaming=True).streaming is True
+
+    def test_node_agents_are_built_once(self, agent):
+        assert agent.agent_query_optimizer is agent.agent_query_optimizer
+        assert agent.agent_answer_refiner is agent.agent_answer_refiner
+
+
+class TestPromptCaching:
+    def test_prompt_is_plain_text_for_openai_models(self):
+        llm = ChatLiteLLM(model="datarobot/azure/gpt-5-mini-2025-08-07")
+
+        assert _cacheable_prompt(llm, "static prompt") == "static prompt"
+
+    def test_prompt_is_marked_cacheable_for_anthropic_models(self):
+        llm = ChatLiteLLM(model="datarobot/anthropic/claude-sonnet-4")
+
+        prompt = _cacheable_prompt(llm, "static prompt")
+
+        assert isinstance(prompt, SystemMessage)
+        assert prompt.content == [
+            {
+                "type": "text",
+                "text": "static prompt",
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+
+
+class TestStreaming:
+    async def test_only_final_node_tokens_are_streamed(self, agent):
+        async def graph_stream():
+            for node, text in [
+                ("query_optimizer", "optimized query"),
+                ("answer_refiner", "final answer"),
+            ]:
+                yield (
+                    (f"{node}:task-id",),
+                    "messages",
+                    (
+                        AIMessageChunk(content=text, id=node),
+                        {"langgraph_node": "agent"},
+                    ),
+                )
+
+        usage = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0}
+        deltas = [
+            event.delta
+            async for event, _, _ in agent._stream_generator(graph_stream(), usage)
+            if isinstance(event, TextMessageContentEvent)
+        ]
+
+        assert deltas == ["final answer"]
+
+    async def test_whole_no_results_message_is_streamed(self, agent):
+        async def graph_stream():
+            yield (
+                (),
+                "messages",
+                (
+                    AIMessage(content=NO_RESULTS_ANSWER, id="no-results"),
+                    {"langgraph_node": "no_results"},
+                ),
+            )
+
+        usage = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0}
+        deltas = [
+            event.delta
+            async for event, _, _ in agent._stream_generator(graph_stream(), usage)
+            if isinstance(event, TextMessageContentEvent)
+        ]
+
+        assert deltas == [NO_RESULTS_ANSWER]
+
+
+class TestRagProbe:
+    async def test_probe_queries_rag_tool_with_raw_question(self, agent):
+        calls: list[str] = []
+        agent.set_mcp_tools([create_rag_tool(calls)])
+
+        update = await agent.rag_probe(
+            {"messages": [HumanMessage(content="What is the refund policy?")]}
+        )
+
+        assert calls == ["What is the refund policy?"]
+        assert update == {"probe_result": "RAG answer for: What is the refund policy?"}
+
+    async def test_probe_reports_missing_rag_tool(self, agent):
+        agent.set_mcp_tools([])
+
+        update = await agent.rag_probe({"messages": [HumanMessage(content="hi")]})
+
+        assert update == {"probe_result": RAG_TOOL_UNAVAILABLE}
+
+
+class TestRagSearcher:
+    async def test_searcher_queries_rag_tool_with_optimized_query(self, agent):
+        calls: list[str] = []
+        agent.set_mcp_tools([create_rag_tool(calls)])
+
+        update = await agent.rag_searcher(
+            {
+                "messages": [
+                    HumanMessage(content="So what's the refund policy, then?"),
+                    AIMessage(content="refund policy return conditions\n"),
+                ]
+            }
+        )
+
+        assert calls == ["refund policy return conditions"]
+        messages: list[Any] = update["messages"]
+        assert len(messages) == 1
+        assert isinstance(messages[0], AIMessage)
+        assert messages[0].content == "RAG answer for: refund policy return conditions"
+
+    async def test_searcher_skips_query_already_probed(self, agent):
+        calls: list[str] = []
+        agent.set_mcp_tools([create_rag_tool(calls)])
+
+        update = await agent.rag_searcher(
+            {
+                "messages": [
+                    HumanMessage(content="Refund  policy"),
+                    AIMessage(content="refund policy\n"),
+                ]
+            }
+        )
+
+        assert calls == []
+        assert update == {"messages": []}
+
+    async def test_searcher_is_noop_without_rag_tool(self, agent):
+        agent.set_mcp_tools([])
+
+        update = await agent.rag_searcher({"messages": [AIMessage(content="query")]})
+
+        assert update == {"messages": []}
+
+
+class TestRouteRetrievals:
+    def test_routes_to_refiner_when_a_branch_has_citations(self, agent):
+        state = {
+            "messages": [
+                HumanMessage(content="q"),
+                AIMessage(content="no documents", name="RAG Searcher"),
+                AIMessage(
+                    content=f"answer\n\n---\n{RAG_CITATIONS_MARKER}\n[1] doc.pdf",
+                    name="RAG Probe",
+                ),
+            ]
+        }
+
+        assert agent.route_retrievals(state) == "refine"
+
+    def test_routes_uncited_answer_to_refiner(self, agent):
+        state = {
+            "messages": [
+                HumanMessage(content="q"),
+                AIMessage(content="Refunds take 5 days.", name="RAG Searcher"),
+            ]
+        }
+
+        assert agent.route_retrievals(state) == "refine"
+
+    def test_routes_to_no_results_when_retrievals_are_empty_or_failed(self, agent):
+        state = {
+            "messages": [
+                HumanMessage(content=f"what does {RAG_CITATIONS_MARKER} mean?"),
+                AIMessage(content="", name="RAG Searcher"),
+                AIMessage(content=RAG_TOOL_UNAVAILABLE, name="RAG Probe"),
+            ]
+        }
+
+        assert agent.route_retrievals(state) == "empty"
+
+    def test_no_results_answers_without_llm(self, agent):
+        update = agent.no_results({"messages": [HumanMessage(content="q")]})
+
+        assert [message.content for message in update["messages"]] == [
+            NO_RESULTS_ANSWER
+        ]
+
+    def test_no_results_shows_error_when_every_retrieval_failed(self, agent):
+        error = "Error: DR_RAG_DEPLOYMENT_ID is not configured."
+        state = {
+            "messages": [
+                HumanMessage(content="q"),
+                AIMessage(content=error, name="RAG Searcher"),
+                AIMessage(content=RAG_TOOL_UNAVAILABLE, name="RAG Probe"),
+            ]
+        }
+
+        update = agent.no_results(state)
+
+        assert [message.content for message in update["messages"]] == [error]
+
+    def test_no_results_shows_error_when_other_retrieval_was_empty(self, agent):
+        state = {
+            "messages": [
+                HumanMessage(content="q"),
+                AIMessage(content="", name="RAG Searcher"),
+                AIMessage(content="Error: timed out", name="RAG Probe"),
+            ]
+        }
+
+        update = agent.no_results(state)
+
+        assert [message.content for message in update["messages"]] == [
+            "Error: timed out"
+        ]
+
+
+class TestMergeResults:
+    def test_merge_appends_probe_result(self, agent):
+        update = agent.merge_results(
+            {"messages": [HumanMessage(content="q")], "probe_result": "found it"}
+        )
+
+        messages: list[Any] = update["messages"]
+        assert len(messages) == 1
+        assert isinstance(messages[0], AIMessage)
+        assert messages[0].content == "found it"
+
+    def test_merge_skips_probe_citing_nothing_new(self, agent):
+        references = f"\n\n---\n{RAG_CITATIONS_MARKER}\n[1] a.pdf (p.3)\n    text..."
+        update = agent.merge_results(
+            {
+                "messages": [
+                    HumanMessage(content="q"),
+                    AIMessage(
+                        content=f"answer{references}\n[2] b.pdf", name="RAG Searcher"
+                    ),
+                ],
+                "probe_result": f"other answer{references}",
+            }
+        )
+
+        assert update == {"messages": []}
+
+    def test_merge_keeps_probe_citing_new_documents(self, agent):
+        update = agent.merge_results(
+            {
+                "messages": [
+                    HumanMessage(content="q"),
+                    AIMessage(
+                        content=f"answer\n\n---\n{RAG_CITATIONS_MARKER}\n[1] a.pdf",
+                        name="RAG Searcher",
+                    ),
+                ],
+                "probe_result": f"answer\n\n---\n{RAG_CITATIONS_MARKER}\n[1] c.pdf",
+            }
+        )
+
+        assert len(update["messages"]) == 1
+
+    def test_merge_keeps_probe_citing_unknown_sources(self, agent):
+        searcher = (
+            f"pricing\n\n---\n{RAG_CITATIONS_MARKER}\n\n[1] Unknown\n"
+            "    Chunk about pricing"
+        )
+        probe = (
+            f"refunds\n\n---\n{RAG_CITATIONS_MARKER}\n\n[1] Unknown\n"
+            "    Totally different chunk about refunds"
+        )
+        update = agent.merge_results(
+            {
+                "messages": [
+                    HumanMessage(content="q"),
+                    AIMessage(content=searcher, name="RAG Searcher"),
+                ],
+                "probe_result": probe,
+            }
+        )
+
+        assert [message.content for message in update["messages"]] == [probe]
+
+    def test_merge_keeps_probe_when_search_failed(self, agent):
+        update = agent.merge_results(
+            {
+                "messages": [
+                    HumanMessage(content="q"),
+                    AIMessage(content="Error: timed out", name="RAG Searcher"),
+                ],
+                "probe_result": "Refunds take 5 days.",
+            }
+        )
+
+        assert [message.content for message in update["messages"]] == [
+            "Refunds take 5 days."
+        ]
+
+    def test_merge_is_noop_without_probe_result(self, agent):
+        update = agent.merge_results({"messages": [HumanMessage(content="q")]})
+
+        assert update == {"messages": []}
+
+
+class TestRagResultCache:
+    def test_rag_tool_is_not_wrapped_when_cache_is_disabled(self, agent):
+        rag_tool = create_rag_tool([])
+
+        agent.set_mcp_tools([rag_tool])
+
+        assert agent.mcp_tools == [rag_tool]
+
+    async def test_repeated_question_is_served_from_cache(self, agent, monkeypatch):
+        monkeypatch.setattr(rag_result_cache, "maxsize", 1024)
+        calls: list[str] = []
+        agent.set_mcp_tools([create_rag_tool(calls)])
+        rag_tool = agent.mcp_tools[0]
+
+        first = await rag_tool.ainvoke({"question": "What is  DataRobot?"})
+        second = await rag_tool.ainvoke({"question": "what is datarobot?"})
+
+        assert first == second
+        assert calls == ["What is  DataRobot?"]
+
+    async def test_error_results_are_not_cached(self):
+        cache = RAGResultCache()
+        calls: list[str] = []
+
+        async def fetch(question: str) -> str:
+            calls.append(question)
+            return "Error: DR_RAG_DEPLOYMENT_ID is not configured."
+
+        await cache.get_or_fetch("q", fetch)
+        await cache.get_or_fetch("q", fetch)
+
+        assert calls == ["q", "q"]
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = RAGResultCache(maxsize=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        cache.get("a")
+        cache.put("c", "C")
+
+        assert cache.get("a") == "A"
+        assert cache.get("b") is None
+        assert cache.get("c") == "C"
+
+    def test_expired_entry_is_dropped(self):
+        cache = RAGResultCache(ttl_seconds=0)
+        cache.put("a", "A")
+
+        assert cache.get("a") is None
+
+    async def test_store_shares_results_between_caches(self, tmp_path):
+        path = str(tmp_path / "rag_cache.sqlite")
+        calls: list[str] = []
+
+        async def fetch(question: str) -> str:
+            calls.append(question)
+            return f"answer for: {question}"
+
+        writer = RAGResultCache(store=SQLiteRAGResultStore(path))
+        reader = RAGResultCache(store=SQLiteRAGResultStore(path))
+
+        await writer.get_or_fetch("q", fetch)
+        result = await reader.get_or_fetch("Q", fetch)
+
+        assert result == "answer for: q"
+        assert calls == ["q"]
+
+    async def test_store_failure_falls_back_to_fetch(self, tmp_path):
+        # A directory cannot be opened as a database, so every store call fails.
+        store = SQLiteRAGResultStore(str(tmp_path))
+        cache = RAGResultCache(store=store)
+        calls: list[str] = []
+
+        async def fetch(question: str) -> str:
+            calls.append(question)
+            return f"answer for: {question}"
+
+        result = await cache.get_or_fetch("q", fetch)
+
+        assert result == "answer for: q"
+        assert calls == ["q"]
+
+    def test_store_prunes_expired_rows_on_put(self, tmp_path):
+        store = SQLiteRAGResultStore(str(tmp_path / "rag_cache.sqlite"))
+        store.put(b"old", "stale")
+        store.ttl_seconds = 0
+        store.put(b"new", "fresh")
+
+        with store._connect() as connection:
+            keys = [row[0] for row in connection.execute("SELECT key FROM rag_results")]
+
+        assert keys == [b"new"]
+
+    def test_namespaces_do_not_share_keys(self):
+        assert RAGResultCache(namespace="a").key("q") != RAGResultCache(
+            namespace="b"
+        ).key("q")
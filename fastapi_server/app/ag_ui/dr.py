@@ -234,14 +234,10 @@ class DataRobotAGUIAgent(AGUIAgent):
             yield RunErrorEvent(message=str(e))
 
     def _prepare_chat_completions_input(self, input: RunAgentInput) -> Dict[str, Any]:
-        messages = []
-        for input_message in input.messages:
-            messages.append(
-                {
-                    "role": input_message.role,
-                    "content": input_message.content,
-                }
-            )
+        messages = [
+            {"role": input_message.role, "content": input_message.content}
+            for input_message in input.messages
+        ]
         # Agent does not currently use the `model` parameter,, butintreface requires it.
         return {
             "messages": messages,
@@ -218,7 +218,6 @@ async def test_run_failed_response(
     dr_agui_agent: DataRobotAGUIAgent,
 ) -> None:
     error_completions(RuntimeError("Error"))
-    result = await run(dr_agui_agent)
     with patch("uuid.uuid4") as uuid4:
         stub_uuid = "8825aa49-97ce-4fdf-9807-2ad9b4158acc"
         uuid4.return_value = uuid.UUID(stub_uuid)
@@ -13,16 +13,33 @@
 # limitations under the License.
 
 import json
-from unittest.mock import MagicMock, patch
+from collections.abc import Iterator
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
 from app.tools.datarobot_rag import (
+    _RESPONSE_CACHE,
     _format_citations,
     query_datarobot_rag,
+    query_datarobot_rag_batch,
     query_datarobot_rag_with_context,
 )
 
+# Shared, never-mutated citation fixtures (a tuple so tests cannot append to it)
+_CITATIONS_AB: tuple[dict[str, object], ...] = (
+    {"content": "First", "metadata": {"source": "a.pdf", "page": "1"}},
+    {"content": "Second", "metadata": {"source": "b.pdf", "page": "2"}},
+)
+
+_HISTORY_JSON = json.dumps(
+    [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi there!"},
+    ]
+)
+
 
 class TestFormatCitations:
     """Tests for the _format_citations helper function."""
@@ -30,42 +47,48 @@ class TestFormatCitations:
     def test_empty_citations(self) -> None:
         assert _format_citations([]) == ""
 
-    def test_single_citation_with_source_and_page(self) -> None:
-        citations = [
-            {
-                "content": "This is some citation content.",
-                "metadata": {"source": "document.pdf", "page": "3"},
-            }
-        ]
+    @pytest.mark.parametrize(
+        ("metadata", "header"),
+        [
+            ({"source": "document.pdf", "page": "3"}, "[1] document.pdf (p.3)"),
+            ({"source": "readme.md"}, "[1] readme.md"),
+            ({}, "[1] Unknown"),
+            ("not a dict", "[1] Unknown"),
+        ],
+    )
+    def test_single_citation_header(self, metadata: object, header: str) -> None:
+        citations = [{"content": "Some content", "metadata": metadata}]
         result = _format_citations(citations)
         assert "**References:**" in result
-        assert "[1] document.pdf (p.3)" in result
-        assert "This is some citation content." in result
+        assert f"\n{header}\n    Some content" in result
 
-    def test_single_citation_without_page(self) -> None:
+    def test_multiple_citations(self) -> None:
+        result = _format_citations(list(_CITATIONS_AB))
+        assert "[1] a.pdf (p.1)" in result
+        assert "[2] b.pdf (p.2)" in result
+
+    def test_citation_deduplication(self) -> None:
         citations = [
-            {
-                "content": "Some content",
-                "metadata": {"source": "readme.md"},
-            }
+            {"content": "First chunk", "metadata": {"source": "a.pdf", "page": "1"}},
+            {"content": "Other page", "metadata": {"source": "a.pdf", "page": "2"}},
+            {"content": "Second chunk", "metadata": {"source": "a.pdf", "page": "1"}},
         ]
         result = _format_citations(citations)
-        assert "[1] readme.md" in result
-        assert "(p." not in result
+        assert result.count("a.pdf (p.1)") == 1
+        assert "First chunk" in result
+        assert "Second chunk" not in result
+        assert "[2] a.pdf (p.2)" in result
 
-    def test_multiple_citations(self) -> None:
+    def test_citations_without_source_are_not_deduplicated(self) -> None:
         citations = [
-            {"content": "First", "metadata": {"source": "a.pdf", "page": "1"}},
-            {"content": "Second", "metadata": {"source": "b.pdf", "page": "2"}},
+            {"content": "A"},
+            {"content": "B"},
+            {"content": "C", "metadata": None},
         ]
         result = _format_citations(citations)
-        assert "[1] a.pdf (p.1)" in result
-        assert "[2] b.pdf (p.2)" in result
-
-    def test_citation_with_empty_metadata(self) -> None:
-        citations = [{"content": "text", "metadata": {}}]
-        result = _format_citations(citations)
-        assert "[1] Unknown" in result
+        assert "[1] Unknown\n    A" in result
+        assert "[2] Unknown\n    B" in result
+        assert "[3] Unknown\n    C" in result
 
     def test_citation_content_truncation(self) -> None:
         long_content = "x" * 300
@@ -77,36 +100,89 @@ class TestFormatCitations:
         assert "x" * 200 + "..." in result
         assert "x" * 201 not in result
 
+    def test_short_citation_content_not_truncated(self) -> None:
+        citations = [{"content": "x" * 200, "metadata": {"source": "doc.pdf"}}]
+        result = _format_citations(citations)
+        assert result.endswith("    " + "x" * 200)
+
+    def test_many_citations(self) -> None:
+        citations = [
+            {"content": f"passage {i}", "metadata": {"source": f"doc{i}.pdf"}}
+            for i in range(1000)
+        ]
+        result = _format_citations(citations)
+        assert result.count("\n[") == 1000
+        assert "[1000] doc999.pdf" in result
+
+
+def _messages(client: MagicMock) -> list[dict[str, str]]:
+    """Return the messages sent in the client's last chat completion call."""
+    call = client.chat.completions.create.call_args
+    messages: list[dict[str, str]] = call.kwargs["messages"]
+    return messages
+
 
 def _make_mock_completion(
     content: str, citations: list[dict[str, object]] | None = None
-) -> MagicMock:
-    """Build a mock ChatCompletion response."""
-    mock = MagicMock()
-    mock.choices = [MagicMock()]
-    mock.choices[0].message.content = content
-    if citations is not None:
-        mock.model_extra = {"citations": citations}
-    else:
-        mock.model_extra = None
-    return mock
-
-
-@pytest.mark.asyncio
+) -> SimpleNamespace:
+    """Build a stand-in ChatCompletion response."""
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        model_extra={"citations": citations} if citations is not None else None,
+    )
+
+
+@pytest.fixture(autouse=True)
+def rag_env(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Configure a RAG deployment by default; tests override as needed."""
+    monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", "deploy-123")
+    monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_SYSTEM_PROMPT", None)
+    _RESPONSE_CACHE.clear()
+
+
+@pytest.fixture(scope="session")
+def openai_client_skeleton() -> MagicMock:
+    """A single mock OpenAI client shared by the whole test session.
+
+    Specced down to `chat.completions.create`, the only path the tools call, so
+    stray attribute access fails instead of silently growing child mocks.
+    """
+    client = MagicMock(spec=["chat"])
+    client.chat = MagicMock(spec=["completions"])
+    client.chat.completions = MagicMock(spec=["create"])
+    client.chat.completions.create = AsyncMock()
+    return client
+
+
+@pytest.fixture
+def mock_client(openai_client_skeleton: MagicMock) -> Iterator[MagicMock]:
+    """The client returned by `_get_openai_client`, reset for each test."""
+    openai_client_skeleton.reset_mock(return_value=True, side_effect=True)
+    with patch(
+        "app.tools.datarobot_rag._get_openai_client",
+        return_value=openai_client_skeleton,
+    ):
+        yield openai_client_skeleton
+
+
 class TestQueryDatarobotRag:
     """Tests for the query_datarobot_rag tool."""
 
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", None)
-    async def test_no_deployment_id(self) -> None:
+    async def test_no_deployment_id(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", None)
         result = await query_datarobot_rag("test question")
         assert "Error" in result
         assert "DR_RAG_DEPLOYMENT_ID" in result
 
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", "deploy-123")
-    @patch("app.tools.datarobot_rag._get_openai_client")
-    async def test_basic_query(self, mock_get_client: MagicMock) -> None:
-        mock_client = MagicMock()
-        mock_get_client.return_value = mock_client
+    async def test_blank_question_skips_deployment(
+        self, mock_client: MagicMock
+    ) -> None:
+        result = await query_datarobot_rag("   ")
+
+        assert result.startswith("Error:")
+        assert mock_client.chat.completions.create.call_count == 0
+
+    async def test_basic_query(self, mock_client: MagicMock) -> None:
         mock_client.chat.completions.create.return_value = (
             _make_mock_completion("The answer is 42.")
         )
@@ -114,100 +190,88 @@ class TestQueryDatarobotRag:
         result = await query_datarobot_rag("What is the answer?")
 
         assert "The answer is 42." in result
-        mock_client.chat.completions.create.assert_called_once()
-        call_kwargs = mock_client.chat.completions.create.call_args
-        messages = call_kwargs.kwargs.get("messages") or call_kwargs[1].get("messages")
+        assert mock_client.chat.completions.create.call_count == 1
+        messages = _messages(mock_client)
         assert any(m["role"] == "user" and "What is the answer?" in m["content"] for m in messages)
 
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", "deploy-123")
-    @patch("app.tools.datarobot_rag._get_openai_client")
-    async def test_query_with_citations(self, mock_get_client: MagicMock) -> None:
-        citations = [
-            {
-                "content": "Relevant passage",
-                "metadata": {"source": "manual.pdf", "page": "5"},
-            }
-        ]
-        mock_client = MagicMock()
-        mock_get_client.return_value = mock_client
+    async def test_query_with_citations(self, mock_client: MagicMock) -> None:
         mock_client.chat.completions.create.return_value = (
-            _make_mock_completion("Answer text", citations)
+            _make_mock_completion("Answer text", list(_CITATIONS_AB))
         )
 
         result = await query_datarobot_rag("question")
 
         assert "Answer text" in result
-        assert "manual.pdf" in result
-        assert "p.5" in result
+        assert "[1] a.pdf (p.1)" in result
+        assert "[2] b.pdf (p.2)" in result
+
+    async def test_malformed_citations_are_ignored(
+        self, mock_client: MagicMock
+    ) -> None:
+        completion = _make_mock_completion("Answer text")
+        completion.model_extra = {"citations": "not a list"}
+        mock_client.chat.completions.create.return_value = completion
+
+        result = await query_datarobot_rag("question")
+
+        assert result == "Answer text"
 
-    @patch.dict(
-        "os.environ", {"DR_RAG_SYSTEM_PROMPT": "You are a helpful assistant."}
-    )
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", "deploy-123")
-    @patch("app.tools.datarobot_rag._get_openai_client")
     async def test_system_prompt_included(
-        self, mock_get_client: MagicMock
+        self, mock_client: MagicMock, monkeypatch: pytest.MonkeyPatch
     ) -> None:
-        mock_client = MagicMock()
-        mock_get_client.return_value = mock_client
+        monkeypatch.setattr(
+            "app.tools.datarobot_rag.DR_RAG_SYSTEM_PROMPT",
+            "You are a helpful assistant.",
+        )
         mock_client.chat.completions.create.return_value = (
             _make_mock_completion("response")
         )
 
         await query_datarobot_rag("question")
 
-        call_kwargs = mock_client.chat.completions.create.call_args
-        messages = call_kwargs.kwargs.get("messages") or call_kwargs[1].get("messages")
+        messages = _messages(mock_client)
         assert messages[0]["role"] == "system"
         assert "helpful assistant" in messages[0]["content"]
 
+    async def test_responses_are_not_cached_by_default(
+        self, mock_client: MagicMock
+    ) -> None:
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+
+        await query_datarobot_rag("question")
+        await query_datarobot_rag("question")
+
+        assert mock_client.chat.completions.create.call_count == 2
+
 
-@pytest.mark.asyncio
 class TestQueryDatarobotRagWithContext:
     """Tests for the query_datarobot_rag_with_context tool."""
 
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", None)
-    async def test_no_deployment_id(self) -> None:
+    async def test_no_deployment_id(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", None)
         result = await query_datarobot_rag_with_context("question")
         assert "Error" in result
 
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", "deploy-123")
-    @patch("app.tools.datarobot_rag._get_openai_client")
-    async def test_with_conversation_history(
-        self, mock_get_client: MagicMock
-    ) -> None:
-        history = json.dumps(
-            [
-                {"role": "user", "content": "Hello"},
-                {"role": "assistant", "content": "Hi there!"},
-            ]
-        )
-        mock_client = MagicMock()
-        mock_get_client.return_value = mock_client
+    async def test_with_conversation_history(self, mock_client: MagicMock) -> None:
         mock_client.chat.completions.create.return_value = (
             _make_mock_completion("Follow-up answer")
         )
 
         result = await query_datarobot_rag_with_context(
-            "Follow-up question", history
+            "Follow-up question", _HISTORY_JSON
         )
 
         assert "Follow-up answer" in result
-        call_kwargs = mock_client.chat.completions.create.call_args
-        messages = call_kwargs.kwargs.get("messages") or call_kwargs[1].get("messages")
+        messages = _messages(mock_client)
         # Should have history + current question
         assert len(messages) == 3
         assert messages[0]["content"] == "Hello"
         assert messages[1]["content"] == "Hi there!"
         assert messages[2]["content"] == "Follow-up question"
 
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", "deploy-123")
-    @patch("app.tools.datarobot_rag._get_openai_client")
-    async def test_with_invalid_history_json(
-        self, mock_get_client: MagicMock
-    ) -> None:
-        mock_client = MagicMock()
-        mock_get_client.return_value = mock_client
+    async def test_with_invalid_history_json(self, mock_client: MagicMock) -> None:
         mock_client.chat.completions.create.return_value = (
             _make_mock_completion("answer")
         )
@@ -217,19 +281,12 @@ class TestQueryDatarobotRagWithContext:
         )
 
         assert "answer" in result
-        call_kwargs = mock_client.chat.completions.create.call_args
-        messages = call_kwargs.kwargs.get("messages") or call_kwargs[1].get("messages")
+        messages = _messages(mock_client)
         # Invalid history should be skipped, only the current question
         assert len(messages) == 1
         assert messages[0]["content"] == "question"
 
-    @patch("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", "deploy-123")
-    @patch("app.tools.datarobot_rag._get_openai_client")
-    async def test_with_empty_history(
-        self, mock_get_client: MagicMock
-    ) -> None:
-        mock_client = MagicMock()
-        mock_get_client.return_value = mock_client
+    async def test_with_empty_history(self, mock_client: MagicMock) -> None:
         mock_client.chat.completions.create.return_value = (
             _make_mock_completion("answer")
         )
@@ -237,6 +294,180 @@ class TestQueryDatarobotRagWithContext:
         result = await query_datarobot_rag_with_context("question", "")
 
         assert "answer" in result
-        call_kwargs = mock_client.chat.completions.create.call_args
-        messages = call_kwargs.kwargs.get("messages") or call_kwargs[1].get("messages")
+        messages = _messages(mock_client)
         assert len(messages) == 1
+
+    async def test_unknown_history_roles_are_sent_as_user(
+        self, mock_client: MagicMock
+    ) -> None:
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+        history = [
+            {"role": "assistant", "content": "Hi there!"},
+            {"role": "tool", "content": "tool output"},
+            {"role": ["user"], "content": "odd role"},
+        ]
+
+        await query_datarobot_rag_with_context("question", json.dumps(history))
+
+        roles = [m["role"] for m in _messages(mock_client)]
+        assert roles == ["assistant", "user", "user", "user"]
+
+    async def test_null_history_content_is_sent_as_empty_string(
+        self, mock_client: MagicMock
+    ) -> None:
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+        history = [{"role": "assistant", "content": None}]
+
+        await query_datarobot_rag_with_context("question", json.dumps(history))
+
+        assert _messages(mock_client)[0] == {"role": "assistant", "content": ""}
+
+    async def test_multi_part_history_content_is_forwarded_unchanged(
+        self, mock_client: MagicMock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_MAX_HISTORY_CHARS", 5)
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+        parts = [{"type": "text", "text": "hi"}, {"type": "text", "text": "you"}]
+        history = [{"role": "user", "content": parts}]
+
+        await query_datarobot_rag_with_context("question", json.dumps(history))
+
+        # Only the 5 characters of text count toward the budget.
+        assert _messages(mock_client)[0] == {"role": "user", "content": parts}
+
+    async def test_long_history_keeps_most_recent_messages(
+        self, mock_client: MagicMock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_MAX_HISTORY", 20)
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+        history = [{"role": "user", "content": f"turn {i}"} for i in range(50)]
+
+        await query_datarobot_rag_with_context("question", json.dumps(history))
+
+        messages = _messages(mock_client)
+        assert len(messages) == 21
+        assert messages[0]["content"] == "turn 30"
+        assert messages[-1]["content"] == "question"
+
+    async def test_history_is_trimmed_to_character_budget(
+        self, mock_client: MagicMock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_MAX_HISTORY_CHARS", 25)
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+        history = [{"role": "user", "content": "x" * 10} for _ in range(5)]
+
+        await query_datarobot_rag_with_context("question", json.dumps(history))
+
+        assert len(_messages(mock_client)) == 3
+
+
+class TestQueryDatarobotRagBatch:
+    """Tests for the query_datarobot_rag_batch tool."""
+
+    async def test_no_deployment_id(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_DEPLOYMENT_ID", None)
+        result = await query_datarobot_rag_batch(["a", "b"])
+        assert "DR_RAG_DEPLOYMENT_ID" in result
+
+    async def test_empty_batch_returns_error(self, mock_client: MagicMock) -> None:
+        result = await query_datarobot_rag_batch([])
+
+        assert result.startswith("Error:")
+        mock_client.chat.completions.create.assert_not_called()
+
+    async def test_answers_are_returned_in_question_order(
+        self, mock_client: MagicMock
+    ) -> None:
+        mock_client.chat.completions.create.side_effect = [
+            _make_mock_completion("first answer"),
+            _make_mock_completion("second answer"),
+        ]
+
+        result = await query_datarobot_rag_batch(["first?", "second?"])
+
+        assert mock_client.chat.completions.create.call_count == 2
+        assert result == (
+            "## [1] first?\n\nfirst answer\n\n## [2] second?\n\nsecond answer"
+        )
+
+    async def test_failed_question_does_not_fail_the_batch(
+        self, mock_client: MagicMock
+    ) -> None:
+        mock_client.chat.completions.create.side_effect = [
+            _make_mock_completion("first answer"),
+            RuntimeError("deployment unavailable"),
+        ]
+
+        result = await query_datarobot_rag_batch(["first?", "second?"])
+
+        assert "first answer" in result
+        assert "## [2] second?\n\nError: deployment unavailable" in result
+
+
+class TestResponseCache:
+    """Tests for the in-process cache of RAG responses."""
+
+    @pytest.fixture(autouse=True)
+    def enable_cache(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_CACHE_TTL", 300)
+
+    async def test_repeated_question_is_served_from_cache(
+        self, mock_client: MagicMock
+    ) -> None:
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("Answer text", list(_CITATIONS_AB))
+        )
+
+        first = await query_datarobot_rag("question")
+        second = await query_datarobot_rag("question")
+
+        assert second == first
+        assert mock_client.chat.completions.create.call_count == 1
+
+    async def test_history_is_part_of_the_key(self, mock_client: MagicMock) -> None:
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+
+        await query_datarobot_rag_with_context("question", _HISTORY_JSON)
+        await query_datarobot_rag_with_context("question", "")
+
+        assert mock_client.chat.completions.create.call_count == 2
+
+    async def test_expired_entry_is_refetched(
+        self, mock_client: MagicMock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_CACHE_TTL", 0)
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+
+        await query_datarobot_rag("question")
+        await query_datarobot_rag("question")
+
+        assert mock_client.chat.completions.create.call_count == 2
+        assert not _RESPONSE_CACHE
+
+    async def test_least_recently_used_entry_is_evicted(
+        self, mock_client: MagicMock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.tools.datarobot_rag.DR_RAG_CACHE_SIZE", 2)
+        mock_client.chat.completions.create.return_value = (
+            _make_mock_completion("answer")
+        )
+
+        for question in ("a", "b", "a", "c", "a", "b"):
+            await query_datarobot_rag(question)
+
+        # "b" was evicted by "c"; "a" stayed because it was used in between.
+        assert mock_client.chat.completions.create.call_count == 4
@@ -33,7 +33,6 @@ def lifecycle() -> ServerLifecycle:
     return ServerLifecycle()
 
 
-@pytest.mark.asyncio
 async def test_init() -> None:
     """Test ServerLifecycle initialization."""
     lifecycle = ServerLifecycle()
@@ -41,7 +40,6 @@ async def test_init() -> None:
     assert lifecycle._logger is not None
 
 
-@pytest.mark.asyncio
 async def test_pre_server_start(
     lifecycle: ServerLifecycle, mock_mcp: MagicMock
 ) -> None:
@@ -50,7 +48,6 @@ async def test_pre_server_start(
     assert lifecycle._mcp == mock_mcp
 
 
-@pytest.mark.asyncio
 async def test_post_server_start(
     lifecycle: ServerLifecycle, mock_mcp: MagicMock
 ) -> None:
@@ -60,7 +57,6 @@ async def test_post_server_start(
     # Add more assertions when post_server_start has actual implementation
 
 
-@pytest.mark.asyncio
 async def test_lifecycle_sequence(
     lifecycle: ServerLifecycle, mock_mcp: MagicMock
 ) -> None:
@@ -14,11 +14,17 @@
 
 """DataRobot RAG tool for querying a RAG deployment via OpenAI-compatible Chat API."""
 
+import asyncio
+import functools
+import hashlib
 import json
 import logging
 import os
+import time
+from collections import OrderedDict
+from typing import Any
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from datarobot_genai.drmcp import dr_mcp_tool
 
@@ -32,6 +38,7 @@ DR_RAG_ENDPOINT = os.environ.get(
 DR_RAG_API_TOKEN = os.environ.get(
     "DR_RAG_API_TOKEN", os.environ.get("DATAROBOT_API_TOKEN", "")
 )
+DR_RAG_SYSTEM_PROMPT = os.environ.get("DR_RAG_SYSTEM_PROMPT")
 
 # Only register as MCP tools when the RAG deployment is configured.
 # When not configured, functions remain defined (for testing) but are not
@@ -42,19 +49,119 @@ if not DR_RAG_DEPLOYMENT_ID:
     )
 _register_tool = dr_mcp_tool() if DR_RAG_DEPLOYMENT_ID else (lambda f: f)
 
+# Returned by every tool while the RAG deployment is not configured
+_ERR_NO_DEPLOYMENT = "Error: DR_RAG_DEPLOYMENT_ID is not configured."
+_ERR_EMPTY_QUESTION = "Error: the question is empty."
+_ERR_NO_QUESTIONS = "Error: no questions were given."
+
 # Model name constant for DataRobot's OpenAI-compatible endpoint
 DEFAULT_CHAT_MODEL_NAME = "datarobot-deployed-llm"
 
+# Maximum number of characters of each citation's content shown in references
+MAX_CITATION_LEN = 200
+
+# Identical requests (same system prompt, history and question) within the TTL
+# are answered from an in-process LRU cache. A TTL or size of 0 disables it.
+# Off by default: after a re-index, cached answers stay stale for up to the TTL.
+DR_RAG_CACHE_TTL = float(os.environ.get("DR_RAG_CACHE_TTL", "0"))
+DR_RAG_CACHE_SIZE = int(os.environ.get("DR_RAG_CACHE_SIZE", "256"))
+
+_RESPONSE_CACHE: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+# Roles accepted from conversation history; anything else is sent as "user".
+# "tool" is excluded because the Chat API requires a tool_call_id with it.
+_HISTORY_ROLES = frozenset({"user", "assistant", "system"})
+
+# Retries of failed deployment requests (connection errors, 408, 409, 429 and
+# 5xx), with exponential backoff done by the OpenAI client.
+DR_RAG_MAX_RETRIES = int(os.environ.get("DR_RAG_MAX_RETRIES", "2"))
+
+# Only the most recent history messages, up to both limits, are forwarded so
+# that long conversations do not make every query slower and more expensive.
+DR_RAG_MAX_HISTORY = int(os.environ.get("DR_RAG_MAX_HISTORY", "20"))
+DR_RAG_MAX_HISTORY_CHARS = int(os.environ.get("DR_RAG_MAX_HISTORY_CHARS", "16000"))
 
-def _get_openai_client() -> OpenAI:
-    """Return an OpenAI client configured for the DataRobot Chat API endpoint."""
+# Maximum number of requests a batch query sends to the deployment at once
+DR_RAG_MAX_CONCURRENCY = int(os.environ.get("DR_RAG_MAX_CONCURRENCY", "8"))
+
+
+@functools.cache
+def _get_openai_client() -> AsyncOpenAI:
+    """Return the async OpenAI client for the DataRobot Chat API endpoint.
+
+    The client is created once and shared so that its connection pool keeps
+    connections to the deployment alive between tool calls.
+    """
     base_url = f"{DR_RAG_ENDPOINT}/deployments/{DR_RAG_DEPLOYMENT_ID}"
-    return OpenAI(base_url=base_url, api_key=DR_RAG_API_TOKEN)
+    return AsyncOpenAI(
+        base_url=base_url, api_key=DR_RAG_API_TOKEN, max_retries=DR_RAG_MAX_RETRIES
+    )
+
+
+def _cache_key(messages: list[dict[str, Any]]) -> str:
+    """Return a stable key for the full list of messages sent to the deployment."""
+    return hashlib.blake2b(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+
+
+def _get_cached_response(key: str) -> str | None:
+    """Return the cached response for `key` unless it is missing or expired."""
+    entry = _RESPONSE_CACHE.get(key)
+    if entry is None:
+        return None
+    stored_at, response = entry
+    if time.monotonic() - stored_at >= DR_RAG_CACHE_TTL:
+        del _RESPONSE_CACHE[key]
+        return None
+    _RESPONSE_CACHE.move_to_end(key)
+    return response
+
+
+def _cache_response(key: str, response: str) -> None:
+    """Store `response`, evicting the least recently used entries over the limit."""
+    if DR_RAG_CACHE_TTL <= 0 or DR_RAG_CACHE_SIZE <= 0 or not response:
+        return
+    _RESPONSE_CACHE[key] = (time.monotonic(), response)
+    _RESPONSE_CACHE.move_to_end(key)
+    while len(_RESPONSE_CACHE) > DR_RAG_CACHE_SIZE:
+        _RESPONSE_CACHE.popitem(last=False)
+
+
+def _citation_source(cite: dict[str, object]) -> tuple[str, str, bool]:
+    """Return the (source, page) a citation refers to, and whether it is known.
+
+    The page is empty if unknown. Citations without a source are shown as
+    "Unknown" and are not identified by it.
+    """
+    metadata = cite.get("metadata", {})
+    if not isinstance(metadata, dict):
+        metadata = {}
+    page = metadata.get("page")
+    return (
+        str(metadata.get("source", "Unknown")),
+        str(page) if page else "",
+        bool(metadata.get("source")),
+    )
+
+
+def _format_citation(index: int, name: str, page: str, cite: dict[str, object]) -> str:
+    """Format a single citation as its reference header and content preview."""
+    content = str(cite.get("content", ""))
+
+    page_text = f" (p.{page})" if page else ""
+    # Short passages are shown as-is; only long ones are cut and marked.
+    if len(content) > MAX_CITATION_LEN:
+        content = f"{content[:MAX_CITATION_LEN]}..."
+    content_text = f"\n    {content}" if content else ""
+    return f"\n\n[{index}] {name}{page_text}{content_text}"
 
 
 def _format_citations(citations: list[dict[str, object]]) -> str:
     """Format citation data from the DataRobot response into readable text.
 
+    Several retrieved chunks often come from the same page; only the first
+    citation for each (source, page) is listed. Citations without a source
+    cannot be told apart and are all kept.
+
     Args:
         citations: List of citation dicts with 'content' and 'metadata' keys.
 
@@ -64,58 +171,100 @@ def _format_citations(citations: list[dict[str, object]]) -> str:
     if not citations:
         return ""
 
-    parts: list[str] = ["\n\n---\n**References:**"]
-    for i, cite in enumerate(citations, 1):
-        metadata = cite.get("metadata", {})
-        if not isinstance(metadata, dict):
-            metadata = {}
-        source = metadata.get("source", "Unknown")
-        page = metadata.get("page", "")
-        content = str(cite.get("content", ""))[:200]
-
-        header = f"\n[{i}] {source}"
-        if page:
-            header += f" (p.{page})"
-        parts.append(header)
-        if content:
-            parts.append(f"    {content}...")
+    entries: list[tuple[str, str, dict[str, object]]] = []
+    seen: set[tuple[str, str]] = set()
+    for cite in citations:
+        name, page, known = _citation_source(cite)
+        if known:
+            if (name, page) in seen:
+                continue
+            seen.add((name, page))
+        entries.append((name, page, cite))
+
+    return "\n\n---\n**References:**" + "".join(
+        _format_citation(i, name, page, cite)
+        for i, (name, page, cite) in enumerate(entries, 1)
+    )
 
-    return "\n".join(parts)
 
+def _history_message(msg: dict[str, Any]) -> dict[str, Any]:
+    """Convert a conversation history entry into a Chat API message.
 
-@_register_tool
-async def query_datarobot_rag(question: str) -> str:
-    """Query the DataRobot RAG deployment and get an answer with citations.
+    String and multi-part (list) content is forwarded unchanged; a null or
+    missing content becomes an empty string.
+    """
+    role = msg.get("role")
+    if not isinstance(role, str) or role not in _HISTORY_ROLES:
+        role = "user"
+    content = msg.get("content")
+    if content is None:
+        content = ""
+    elif not isinstance(content, (str, list)):
+        content = str(content)
+    return {"role": role, "content": content}
+
+
+def _content_chars(content: str | list[Any]) -> int:
+    """Count the characters of message content, using only the text of parts."""
+    if isinstance(content, str):
+        return len(content)
+    return sum(
+        len(part["text"])
+        for part in content
+        if isinstance(part, dict) and isinstance(part.get("text"), str)
+    )
 
-    Use this tool when you need to search internal documents or knowledge bases
-    to answer a user's question. The tool sends the question to DataRobot's
-    RAG pipeline which searches a vector database for relevant documents and
-    generates an answer using an LLM.
 
-    Args:
-        question: The question text to ask the RAG system.
+def _recent_history_messages(history: list[Any]) -> list[dict[str, Any]]:
+    """Convert the newest history entries within both limits into messages.
 
-    Returns:
-        The answer text with citation references appended.
+    The message-count window is applied to the decoded list before any message
+    is built, so entries that would be dropped anyway are never converted.
     """
-    if not DR_RAG_DEPLOYMENT_ID:
-        return "Error: DR_RAG_DEPLOYMENT_ID is not configured."
+    window = history[-DR_RAG_MAX_HISTORY:] if DR_RAG_MAX_HISTORY > 0 else []
+    kept = [_history_message(msg) for msg in window if isinstance(msg, dict)]
+    total = 0
+    for i in range(len(kept) - 1, -1, -1):
+        total += _content_chars(kept[i]["content"])
+        if total > DR_RAG_MAX_HISTORY_CHARS:
+            return kept[i + 1 :]
+    return kept
 
-    client = _get_openai_client()
 
-    messages: list[dict[str, str]] = []
+def _question_messages(question: str) -> list[dict[str, str]]:
+    """Build the messages for a single question without conversation history."""
+    user_message = {"role": "user", "content": question}
+    if DR_RAG_SYSTEM_PROMPT:
+        return [{"role": "system", "content": DR_RAG_SYSTEM_PROMPT}, user_message]
+    return [user_message]
 
-    system_prompt = os.environ.get("DR_RAG_SYSTEM_PROMPT")
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
 
-    messages.append({"role": "user", "content": question})
+async def _run_rag(messages: list[dict[str, Any]]) -> str:
+    """Send `messages` to the RAG deployment and return the answer with citations.
+
+    When DR_RAG_CACHE_TTL is set, responses are served from the in-process
+    cache if the same messages were sent within that many seconds.
+    """
+    if not DR_RAG_DEPLOYMENT_ID:
+        return _ERR_NO_DEPLOYMENT
+    # The question is always the last message; a blank one is not worth a
+    # round-trip to the deployment.
+    if not messages[-1]["content"].strip():
+        return _ERR_EMPTY_QUESTION
+
+    key = _cache_key(messages)
+    cached = _get_cached_response(key)
+    if cached is not None:
+        logger.debug("Returning cached RAG response")
+        return cached
 
     logger.info(
-        "Sending query to DataRobot RAG deployment %s", DR_RAG_DEPLOYMENT_ID
+        "Sending query to DataRobot RAG deployment %s with %d messages",
+        DR_RAG_DEPLOYMENT_ID,
+        len(messages),
     )
 
-    completion = client.chat.completions.create(
+    completion = await _get_openai_client().chat.completions.create(
         model=DEFAULT_CHAT_MODEL_NAME,
         messages=messages,  # type: ignore[arg-type]
         stream=False,
@@ -124,13 +273,31 @@ async def query_datarobot_rag(question: str) -> str:
     content = completion.choices[0].message.content or ""
 
     # Extract citations from DataRobot-specific extension fields
-    citations: list[dict[str, object]] = []
-    if hasattr(completion, "model_extra") and completion.model_extra:
-        citations = completion.model_extra.get("citations", [])
+    citations = (getattr(completion, "model_extra", None) or {}).get("citations")
+    if not isinstance(citations, list):
+        citations = []
+
+    result = content + (_format_citations(citations) if citations else "")
+    _cache_response(key, result)
+    return result
 
-    citation_text = _format_citations(citations)
 
-    return content + citation_text
+@_register_tool
+async def query_datarobot_rag(question: str) -> str:
+    """Query the DataRobot RAG deployment and get an answer with citations.
+
+    Use this tool when you need to search internal documents or knowledge bases
+    to answer a user's question. The tool sends the question to DataRobot's
+    RAG pipeline which searches a vector database for relevant documents and
+    generates an answer using an LLM.
+
+    Args:
+        question: The question text to ask the RAG system.
+
+    Returns:
+        The answer text with citation references appended.
+    """
+    return await _run_rag(_question_messages(question))
 
 
 @_register_tool
@@ -152,52 +319,61 @@ async def query_datarobot_rag_with_context(
     Returns:
         The answer text with citation references appended.
     """
-    if not DR_RAG_DEPLOYMENT_ID:
-        return "Error: DR_RAG_DEPLOYMENT_ID is not configured."
-
-    client = _get_openai_client()
+    if not conversation_history:
+        return await _run_rag(_question_messages(question))
 
-    messages: list[dict[str, str]] = []
+    messages: list[dict[str, Any]] = []
 
-    system_prompt = os.environ.get("DR_RAG_SYSTEM_PROMPT")
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
+    if DR_RAG_SYSTEM_PROMPT:
+        messages.append({"role": "system", "content": DR_RAG_SYSTEM_PROMPT})
 
     # Restore conversation history
-    if conversation_history:
-        try:
-            history = json.loads(conversation_history)
-            if isinstance(history, list):
-                for msg in history:
-                    if isinstance(msg, dict):
-                        messages.append(
-                            {
-                                "role": msg.get("role", "user"),
-                                "content": msg.get("content", ""),
-                            }
-                        )
-        except json.JSONDecodeError:
-            logger.warning("Failed to parse conversation_history JSON")
+    try:
+        history = json.loads(conversation_history)
+        if isinstance(history, list):
+            messages.extend(_recent_history_messages(history))
+    except json.JSONDecodeError:
+        logger.warning("Failed to parse conversation_history JSON")
 
     messages.append({"role": "user", "content": question})
 
-    logger.info(
-        "Sending contextual query to DataRobot RAG deployment %s "
-        "with %d history messages",
-        DR_RAG_DEPLOYMENT_ID,
-        len(messages) - 1,
-    )
+    return await _run_rag(messages)
 
-    completion = client.chat.completions.create(
-        model=DEFAULT_CHAT_MODEL_NAME,
-        messages=messages,  # type: ignore[arg-type]
-        stream=False,
-    )
 
-    content = completion.choices[0].message.content or ""
+@_register_tool
+async def query_datarobot_rag_batch(questions: list[str]) -> str:
+    """Query the DataRobot RAG deployment with several independent questions.
 
-    citations: list[dict[str, object]] = []
-    if hasattr(completion, "model_extra") and completion.model_extra:
-        citations = completion.model_extra.get("citations", [])
+    Use this tool instead of calling query_datarobot_rag repeatedly when you
+    need answers to multiple unrelated questions, e.g. to research each part
+    of a larger question. The questions are sent concurrently.
+
+    Args:
+        questions: The question texts to ask the RAG system.
+
+    Returns:
+        Each question followed by its answer with citation references.
+    """
+    if not DR_RAG_DEPLOYMENT_ID:
+        return _ERR_NO_DEPLOYMENT
+    if not questions:
+        return _ERR_NO_QUESTIONS
+
+    semaphore = asyncio.Semaphore(max(DR_RAG_MAX_CONCURRENCY, 1))
+
+    async def ask(question: str) -> str:
+        async with semaphore:
+            return await _run_rag(_question_messages(question))
+
+    # A failed question is reported in place rather than failing the batch.
+    results = await asyncio.gather(
+        *(ask(question) for question in questions), return_exceptions=True
+    )
 
-    return content + _format_citations(citations)
+    sections: list[str] = []
+    for i, (question, result) in enumerate(zip(questions, results), 1):
+        if isinstance(result, BaseException):
+            logger.warning("RAG query %d of the batch failed: %s", i, result)
+            result = f"Error: {result}"
+        sections.append(f"## [{i}] {question}\n\n{result}")
+    return "\n\n".join(sections)